@@ -1,18 +1,42 @@
-# bot.py — aiogram 3.7+, long polling, автоснос webhook при конфликте
+# bot.py — aiogram 3.7+, long polling (webhook снимается при старте) или webhook-режим
 
 import os
+import json
 import asyncio
 import logging
-from typing import Literal
+import secrets
+import signal
+import time
+from collections import OrderedDict, deque
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Literal
 
-from aiogram import Bot, Dispatcher, F
-from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiohttp import FormData
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiogram.filters import CommandStart, Command, StateFilter
+from aiogram.types import ErrorEvent, Message, ReplyKeyboardMarkup, KeyboardButton, TelegramObject
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramConflictError  # <- важно
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.utils.backoff import BackoffConfig
+
+# orjson заметно быстрее stdlib json на (де)сериализации запросов к Bot API
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps, json_loads = json.dumps, json.loads
 
 TOKEN = os.getenv("BOT_TOKEN", "").strip()
 if not TOKEN:
@@ -24,6 +48,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger("ai-helper-bot")
 
+# webhook-режим включается, если задан WEBHOOK_URL (публичный https-адрес без пути)
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH   = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+# секрет обязателен: без него кто угодно может слать поддельные апдейты на WEBHOOK_PATH.
+# Если не задан — генерируем на старте (для нескольких реплик задайте общий явно).
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or secrets.token_urlsafe(32)
+WEB_HOST       = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT       = int(os.getenv("PORT", "8080"))
+
+# FSM в Redis, если задан REDIS_URL (иначе — в памяти процесса)
+REDIS_URL = os.getenv("REDIS_URL", "").strip()
+FSM_TTL   = 24 * 3600  # брошенные диалоги сами исчезают из Redis через сутки
+
+ALLOWED_UPDATES = ["message"]
+POLLING_TIMEOUT = 50          # long polling: сервер держит getUpdates до 50с (максимум Telegram)
+# бэкофф aiogram между неудачными getUpdates (любыми, не только 409): задержки
+# по умолчанию aiogram (1→5с, ×1.3), только джиттер ±20% разводит реплики по времени
+POLLING_BACKOFF = BackoffConfig(min_delay=1.0, max_delay=5.0, factor=1.3, jitter=0.2)
+HTTP_TIMEOUT = 60             # таймаут обычных запросов; для getUpdates aiogram прибавляет POLLING_TIMEOUT
+MAX_CONCURRENT_UPDATES = 256  # потолок одновременно обрабатываемых апдейтов
+TEXT_CLIP_LEN = 200           # сколько символов пользовательского текста цитируем в ответе
+TEXT_SCAN_LEN = 256           # strip() смотрит только на начало сообщения (до 4096 симв.)
+SEND_RATE = 25                # Telegram: ~30 исходящих сообщений/с на бота, держим запас
+SEND_BURST = 5                # запас сверх темпа: в любую секунду уходит не больше 25 + 5
+SEND_CHAT_INTERVAL = 1.05     # и не чаще ~1 сообщения в секунду в один чат
+SEND_MAX_RETRIES = 3          # сколько раз повторяем отправку после 429
+DEBOUNCE_WINDOW = 1.0         # одинаковые сообщения от юзера чаще — считаем дублем
+DEBOUNCE_CACHE_SIZE = 10_000  # сколько последних (user_id, текст) помним для антидребезга
+DRAIN_TIMEOUT = 10            # сколько ждём апдейты в обработке при остановке
+ERROR_BURST_LIMIT = 10        # больше ошибок в секунду — логируем без traceback
+
+# пул соединений к Bot API: держим TLS-коннекты живыми и кэшируем DNS
+HTTP_CONNECTOR_KWARGS = {
+    "limit": 200,
+    "limit_per_host": 100,
+    "ttl_dns_cache": 300,
+    "keepalive_timeout": 75,
+    "enable_cleanup_closed": True,
+}
+# адрес локального Bot API server (например, http://localhost:8081), если он поднят рядом
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()
+
 # ==== Клавиатура ====
 BTN_CANT_START = "Не могу начать"
 BTN_DISTRACTED = "Отвлекаюсь"
@@ -39,10 +105,229 @@ MAIN_KB = ReplyKeyboardMarkup(
     input_field_placeholder="Нажми кнопку или опиши ситуацию текстом…"
 )
 
+# ==== Тексты ====
+START_TEXT = "Привет! Я твой AI-помогатор. Нажми кнопку ниже или опиши ситуацию текстом."
+HELP_TEXT = ("Доступно:\n"
+             "• /start — главное меню\n"
+             "• Кнопки: «Не могу начать», «Отвлекаюсь», «Перегруз», «Нужен перерыв»\n"
+             "• Или просто напиши свободным текстом.")
+FREE_TEXT_FALLBACK = ("Понял. Давай структурируем:\n"
+                      "1) Цель на 20–30 минут?\n"
+                      "2) Первый шаг на 5–10 минут?\n"
+                      "3) Один барьер?\n\n"
+                      "Можешь ответить пунктами или нажми кнопку ниже.")
+NONTEXT_PROMPT = "Опиши, пожалуйста, словами — что происходит? 🙂"
+OTHER_PROMPT = "Я понимаю только текст. Напиши пару слов или нажми кнопку ниже."
+
+# ==== HTTP-сессия ====
+class CachedKeyboardSession(AiohttpSession):
+    """AiohttpSession, который сериализует статичные клавиатуры в JSON один раз.
+
+    Обычно aiogram делает model_dump + json.dumps клавиатуры на каждом запросе;
+    для зарегистрированных здесь разметок берём готовую строку из кэша.
+    connector_kwargs дополняют параметры TCPConnector (размер пула, DNS-кэш…).
+    """
+
+    def __init__(self, *static_markups, connector_kwargs: dict[str, Any] | None = None, **kwargs):
+        super().__init__(**kwargs)
+        if connector_kwargs:
+            self._connector_init.update(connector_kwargs)
+        self._static_markups = {id(m): m for m in static_markups}
+        self._markup_json: dict[int, str] = {}
+
+    def build_form_data(self, bot: Bot, method: TelegramMethod) -> FormData:
+        markup = getattr(method, "reply_markup", None)
+        if id(markup) not in self._static_markups:
+            return super().build_form_data(bot, method)
+
+        markup_json = self._markup_json.get(id(markup))
+        if markup_json is None:
+            markup_json = self.prepare_value(markup.model_dump(warnings=False), bot=bot, files={})
+            self._markup_json[id(markup)] = markup_json
+
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if value:
+                form.add_field(key, value)
+        form.add_field("reply_markup", markup_json)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+class TokenBucket:
+    """Token bucket: `rate` токенов в секунду, не больше `capacity` в запасе.
+
+    Каждый вызов acquire() сразу резервирует себе слот (как GCRA) и спит ровно
+    до него один раз — без общих пробуждений всех ждущих.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self._interval = 1 / rate
+        self._burst = (capacity - 1) * self._interval  # насколько можно опередить график
+        self._tat = 0.0  # теоретическое время следующей отправки
+
+    async def acquire(self):
+        now = asyncio.get_running_loop().time()
+        tat = max(self._tat, now)
+        slot = max(now, tat - self._burst)
+        self._tat = tat + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class SendRateLimitMiddleware(BaseRequestMiddleware):
+    """Держит исходящие send*-запросы в лимитах Telegram и повторяет их после 429.
+
+    Глобальный лимит — token bucket, в каждый чат — не чаще раза в `chat_interval`
+    секунд. Остальные методы (getUpdates, setWebhook, …) проходят без ограничений.
+    """
+
+    def __init__(self, rate: float, burst: int, chat_interval: float, max_retries: int):
+        self._bucket = TokenBucket(rate, capacity=burst)
+        self._chat_interval = chat_interval
+        self._chat_locks: dict[int | str, asyncio.Lock] = {}
+        self._chat_sent: dict[int | str, float] = {}  # chat_id -> когда реально ушёл последний запрос
+        self._max_retries = max_retries
+
+    async def _acquire(self, chat_id: int | str | None):
+        # интервал в чате считаем от фактической отправки, а не от резерва:
+        # иначе ожидание в общем bucket «съедает» паузу и два сообщения в чат
+        # уходят почти подряд. Лок держим только до отправки, не до ответа.
+        if chat_id is None:
+            await self._bucket.acquire()
+            return
+        loop = asyncio.get_running_loop()
+        if len(self._chat_sent) > 10_000:
+            stale = loop.time() - self._chat_interval
+            for key in [k for k, t in self._chat_sent.items() if t < stale]:
+                lock = self._chat_locks.get(key)
+                if lock is None or not lock.locked():
+                    self._chat_locks.pop(key, None)
+                    del self._chat_sent[key]
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            delay = self._chat_sent.get(chat_id, float("-inf")) + self._chat_interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._bucket.acquire()
+            self._chat_sent[chat_id] = loop.time()
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ) -> Response:
+        if not method.__api_method__.startswith("send"):
+            return await make_request(bot, method)
+
+        attempt = 0
+        while True:
+            await self._acquire(getattr(method, "chat_id", None))
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self._max_retries:
+                    raise
+                attempt += 1
+                logger.warning("Flood control: %s ждёт %sс (попытка %s)", method.__api_method__, e.retry_after, attempt)
+                await asyncio.sleep(e.retry_after)
+
+# ==== Middleware ====
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Не даёт обрабатывать больше `limit` апдейтов одновременно.
+
+    С handle_as_tasks=True каждый апдейт — отдельная задача; семафор держит
+    всплеск нагрузки в рамках, остальные апдейты ждут своей очереди.
+    Заодно помним задачи в работе, чтобы при остановке дать им доделаться.
+    """
+
+    def __init__(self, limit: int):
+        self._sem = asyncio.Semaphore(limit)
+        self._inflight: set[asyncio.Task] = set()
+
+    async def drain(self, timeout: float):
+        """Ждёт завершения апдейтов в обработке, но не дольше `timeout` секунд."""
+        if not self._inflight:
+            return
+        logger.info("Дожидаюсь %s апдейт(ов) в обработке…", len(self._inflight))
+        _, pending = await asyncio.wait(set(self._inflight), timeout=timeout)
+        if pending:
+            logger.warning("Не дождались %s апдейт(ов) за %sс", len(pending), timeout)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        task = asyncio.current_task()
+        self._inflight.add(task)
+        try:
+            async with self._sem:
+                return await handler(event, data)
+        finally:
+            self._inflight.discard(task)
+
+class DebounceMiddleware(BaseMiddleware):
+    """Гасит повторные нажатия: тот же текст от того же пользователя чаще раза в `window` с.
+
+    Такой апдейт не доходит до хэндлеров, и бот не тратит на него лишний sendMessage.
+    Сравниваем message.date — время отправки по часам Telegram (секунды), а не время
+    обработки: после бэкоффа или очереди на семафоре пачка апдейтов разбирается за
+    миллисекунды, и настоящие повторы, отправленные в разное время, терять нельзя.
+    Последние `maxsize` пар (user_id, текст) держим в LRU — память ограничена.
+    """
+
+    def __init__(self, window: float, maxsize: int):
+        self._window = window
+        self._maxsize = maxsize
+        self._last: OrderedDict[tuple[int, str], float] = OrderedDict()  # -> date принятого сообщения
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if event.from_user is None or not event.text:
+            return await handler(event, data)
+
+        sent_at = event.date.timestamp()
+        key = (event.from_user.id, event.text)
+        last = self._last.get(key)
+        # abs: задачи из одной пачки могут дойти сюда не в порядке отправки
+        if last is not None and abs(sent_at - last) < self._window:
+            return None
+        self._last[key] = sent_at
+        self._last.move_to_end(key)
+        if len(self._last) > self._maxsize:
+            self._last.popitem(last=False)
+        return await handler(event, data)
+
+class NormalizeTextMiddleware(BaseMiddleware):
+    """Один раз на сообщение готовит text_clip — текст без пробелов по краям,
+    обрезанный до TEXT_CLIP_LEN символов для вставки в ответ.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        data["text_clip"] = (event.text or "")[:TEXT_SCAN_LEN].strip()[:TEXT_CLIP_LEN]
+        return await handler(event, data)
+
 # ==== FSM ====
 TopicType = Literal["cant_start", "distracted", "overload", "need_break"]
+# тема хранится прямо в имени состояния — без отдельного get_data/update_data
 class Flow(StatesGroup):
-    waiting_topic_details = State()
+    waiting_cant_start = State()
+    waiting_distracted = State()
+    waiting_overload   = State()
+    waiting_need_break = State()
 
 TOPIC_MAP = {
     BTN_CANT_START: "cant_start",
@@ -50,154 +335,279 @@ TOPIC_MAP = {
     BTN_OVERLOAD:   "overload",
     BTN_BREAK:      "need_break",
 }
+TOPIC_KEYS = frozenset(TOPIC_MAP)
+
+TOPIC_STATES: dict[TopicType, State] = {
+    "cant_start": Flow.waiting_cant_start,
+    "distracted": Flow.waiting_distracted,
+    "overload":   Flow.waiting_overload,
+    "need_break": Flow.waiting_need_break,
+}
+STATE_TO_TOPIC: dict[str, TopicType] = {st.state: topic for topic, st in TOPIC_STATES.items()}
+
+TOPIC_INTROS: dict[TopicType, str] = {
+    "cant_start": ("Окей, тема: «Не могу начать».\n"
+                   "1) Сократим шаг до 10–15 минут.\n"
+                   "2) Что мешает начать прямо сейчас?\n"
+                   "3) Таймер 10 минут.\n\n"
+                   "Опиши, что пытаешься начать и что стопорит."),
+    "distracted": ("Тема: «Отвлекаюсь».\n"
+                   "1) Вылечи уведомления/вкладки.\n"
+                   "2) Одно рабочее окно.\n"
+                   "3) 15–20 минут фокус + короткий перерыв.\n\n"
+                   "Что именно отвлекает?"),
+    "overload":   ("Тема: «Перегруз».\n"
+                   "1) Выгрузи задачи (можно сюда).\n"
+                   "2) Отметь срочность/важность.\n"
+                   "3) 1 шаг на 25 минут.\n\n"
+                   "Что давит сильнее всего?"),
+    "need_break": ("Тема: «Нужен перерыв».\n"
+                   "1) 5–10 минут — вода/движение/дыхание.\n"
+                   "2) Усталость 1–10.\n"
+                   "3) Один шаг после паузы.\n\n"
+                   "Как самочувствие и сколько времени на отдых?"),
+}
+
+# шаблоны ответов: единственный плейсхолдер {clip} — обрезанный текст пользователя
+TOPIC_RESPONSE_TEMPLATES: dict[TopicType, str] = {
+    "cant_start": ("Действуем:\n"
+                   "• Первый шаг на 10 минут, без перфекционизма.\n"
+                   "• Учёл контекст: «{clip}».\n"
+                   "• После — короткий отчёт. Готов?"),
+    "distracted": ("Фиксируем отвлечения:\n"
+                   "• Закрой лишнее, включи «Не беспокоить».\n"
+                   "• Одно рабочее окно на 15 минут.\n"
+                   "• Триггеры: «{clip}» — учёл.\n"
+                   "Отпишись через 15 минут."),
+    "overload":   ("Снимаем перегруз:\n"
+                   "• Выпиши задачи.\n"
+                   "• Выбери одну «срочно/важно» на 25 минут.\n"
+                   "• Ключевые пункты: «{clip}».\n"
+                   "Стартуем?"),
+    "need_break": ("Перерыв без чувства вины:\n"
+                   "• 7 минут оффлайн: вода/движение/дыхание.\n"
+                   "• Вернёшься — один минимальный шаг.\n"
+                   "• Запомнил контекст: «{clip}».\n"
+                   "Поставь таймер и вернись."),
+}
 
 def topic_intro(topic: TopicType) -> str:
-    if topic == "cant_start":
-        return ("Окей, тема: «Не могу начать».\n"
-                "1) Сократим шаг до 10–15 минут.\n"
-                "2) Что мешает начать прямо сейчас?\n"
-                "3) Таймер 10 минут.\n\n"
-                "Опиши, что пытаешься начать и что стопорит.")
-    if topic == "distracted":
-        return ("Тема: «Отвлекаюсь».\n"
-                "1) Вылечи уведомления/вкладки.\n"
-                "2) Одно рабочее окно.\n"
-                "3) 15–20 минут фокус + короткий перерыв.\n\n"
-                "Что именно отвлекает?")
-    if topic == "overload":
-        return ("Тема: «Перегруз».\n"
-                "1) Выгрузи задачи (можно сюда).\n"
-                "2) Отметь срочность/важность.\n"
-                "3) 1 шаг на 25 минут.\n\n"
-                "Что давит сильнее всего?")
-    return ("Тема: «Нужен перерыв».\n"
-            "1) 5–10 минут — вода/движение/дыхание.\n"
-            "2) Усталость 1–10.\n"
-            "3) Один шаг после паузы.\n\n"
-            "Как самочувствие и сколько времени на отдых?")
-
-def topic_response(topic: TopicType, user_text: str) -> str:
-    clip = user_text.strip()[:200]
-    if topic == "cant_start":
-        return ("Действуем:\n"
-                "• Первый шаг на 10 минут, без перфекционизма.\n"
-                f"• Учёл контекст: «{clip}».\n"
-                "• После — короткий отчёт. Готов?")
-    if topic == "distracted":
-        return ("Фиксируем отвлечения:\n"
-                "• Закрой лишнее, включи «Не беспокоить».\n"
-                "• Одно рабочее окно на 15 минут.\n"
-                f"• Триггеры: «{clip}» — учёл.\n"
-                "Отпишись через 15 минут.")
-    if topic == "overload":
-        return ("Снимаем перегруз:\n"
-                "• Выпиши задачи.\n"
-                "• Выбери одну «срочно/важно» на 25 минут.\n"
-                f"• Ключевые пункты: «{clip}».\n"
-                "Стартуем?")
-    return ("Перерыв без чувства вины:\n"
-            "• 7 минут оффлайн: вода/движение/дыхание.\n"
-            "• Вернёшься — один минимальный шаг.\n"
-            f"• Запомнил контекст: «{clip}».\n"
-            "Поставь таймер и вернись.")
+    return TOPIC_INTROS[topic]
+
+def topic_response(topic: TopicType, clip: str) -> str:
+    return TOPIC_RESPONSE_TEMPLATES[topic].format(clip=clip)
+
+async def reply(message: Message, text: str):
+    # все ответы бота идут с главной клавиатурой; answer() сохраняет топик форума
+    # (message_thread_id) и business_connection_id исходного сообщения
+    await message.answer(text, reply_markup=MAIN_KB)
 
 async def select_topic(message: Message, state: FSMContext, topic: TopicType):
-    await state.set_state(Flow.waiting_topic_details)
-    await state.update_data(topic=topic)
-    await message.answer(topic_intro(topic), reply_markup=MAIN_KB)
+    await state.set_state(TOPIC_STATES[topic])
+    await reply(message, topic_intro(topic))
+
+def make_fsm_storage() -> BaseStorage:
+    if not REDIS_URL:
+        return MemoryStorage()
+    from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+    logger.info("FSM-хранилище: Redis")
+    return RedisStorage.from_url(
+        REDIS_URL,
+        key_builder=DefaultKeyBuilder(with_bot_id=True),
+        state_ttl=FSM_TTL,
+        data_ttl=FSM_TTL,
+        json_loads=json_loads,
+        json_dumps=json_dumps,
+    )
 
 # ==== Инициализация ====
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher(storage=MemoryStorage())
+session = CachedKeyboardSession(
+    MAIN_KB,
+    connector_kwargs=HTTP_CONNECTOR_KWARGS,
+    timeout=HTTP_TIMEOUT,
+    json_loads=json_loads,
+    json_dumps=json_dumps,
+    api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=True) if TELEGRAM_API_URL else PRODUCTION,
+)
+session.middleware(SendRateLimitMiddleware(SEND_RATE, SEND_BURST, SEND_CHAT_INTERVAL, SEND_MAX_RETRIES))
+bot = Bot(
+    token=TOKEN,
+    session=session,
+    default=DefaultBotProperties(parse_mode="HTML"),
+)
+dp = Dispatcher(storage=make_fsm_storage())
+concurrency_limit = ConcurrencyLimitMiddleware(MAX_CONCURRENT_UPDATES)
+dp.update.outer_middleware(concurrency_limit)
+dp.message.outer_middleware(DebounceMiddleware(DEBOUNCE_WINDOW, DEBOUNCE_CACHE_SIZE))
+dp.message.outer_middleware(NormalizeTextMiddleware())
+
+async def drain_updates():
+    await concurrency_limit.drain(DRAIN_TIMEOUT)
+
+# aiogram регистрирует fsm.close первым обработчиком shutdown; апдейтам в обработке
+# хранилище ещё нужно, поэтому дожидаемся их раньше закрытия
+dp.shutdown.register(drain_updates)
+dp.shutdown.handlers.insert(0, dp.shutdown.handlers.pop())
 
 # ==== Хэндлеры ====
-@dp.message(CommandStart())
+# команды — отдельным роутером и первыми: до текстовых magic-фильтров дело не доходит
+commands_router = Router(name="commands")
+text_router = Router(name="text")
+
+@commands_router.message(CommandStart())
 async def on_start(message: Message, state: FSMContext):
     await state.clear()
-    await message.answer(
-        "Привет! Я твой AI-помогатор. Нажми кнопку ниже или опиши ситуацию текстом.",
-        reply_markup=MAIN_KB
-    )
+    await reply(message, START_TEXT)
 
-@dp.message(Command("help"))
+@commands_router.message(Command("help"))
 async def on_help(message: Message):
-    await message.answer(
-        "Доступно:\n"
-        "• /start — главное меню\n"
-        "• Кнопки: «Не могу начать», «Отвлекаюсь», «Перегруз», «Нужен перерыв»\n"
-        "• Или просто напиши свободным текстом.",
-        reply_markup=MAIN_KB
-    )
+    await reply(message, HELP_TEXT)
 
-@dp.message(F.text.in_(list(TOPIC_MAP.keys())))
+@text_router.message(F.text.in_(TOPIC_KEYS))
 async def on_topic_selected(message: Message, state: FSMContext):
     await select_topic(message, state, TOPIC_MAP[message.text])
 
-@dp.message(Flow.waiting_topic_details, F.text.len() > 0)
-async def on_topic_details(message: Message, state: FSMContext):
-    data = await state.get_data()
-    topic: TopicType = data.get("topic", "cant_start")
-    reply = topic_response(topic, message.text)
-    await message.answer(reply, reply_markup=MAIN_KB)
+@text_router.message(StateFilter(Flow), F.text)
+async def on_topic_details(message: Message, state: FSMContext, raw_state: str, text_clip: str):
+    # raw_state aiogram уже достал из хранилища — повторно не читаем
+    topic = STATE_TO_TOPIC.get(raw_state, "cant_start")
+    await reply(message, topic_response(topic, text_clip))
     await state.clear()
 
-@dp.message(Flow.waiting_topic_details)
+@text_router.message(StateFilter(Flow))
 async def on_topic_details_nontext(message: Message):
-    await message.answer("Опиши, пожалуйста, словами — что происходит? 🙂", reply_markup=MAIN_KB)
+    await reply(message, NONTEXT_PROMPT)
 
-@dp.message(F.text.len() > 0)
-async def on_free_text(message: Message, state: FSMContext):
-    text = message.text.strip()
-    if text in TOPIC_MAP:
-        await select_topic(message, state, TOPIC_MAP[text])
-        return
-    await message.answer(
-        "Понял. Давай структурируем:\n"
-        "1) Цель на 20–30 минут?\n"
-        "2) Первый шаг на 5–10 минут?\n"
-        "3) Один барьер?\n\n"
-        "Можешь ответить пунктами или нажми кнопку ниже.",
-        reply_markup=MAIN_KB
-    )
+@text_router.message(F.text)
+async def on_free_text(message: Message):
+    await reply(message, FREE_TEXT_FALLBACK)
 
-@dp.message()
+@text_router.message()
 async def on_other(message: Message):
-    await message.answer("Я понимаю только текст. Напиши пару слов или нажми кнопку ниже.", reply_markup=MAIN_KB)
+    await reply(message, OTHER_PROMPT)
+
+dp.include_routers(commands_router, text_router)
 
 # ==== Errors ====
+_recent_errors: deque[float] = deque(maxlen=ERROR_BURST_LIMIT)
+
 @dp.errors()
-async def errors_handler(update, exception):
-    logger.exception("Ошибка в обработчике: %s | update=%s", exception, update)
+async def errors_handler(event: ErrorEvent):
+    # логируем только update_id: repr всего апдейта дорогой и при шквале ошибок тормозит
+    update_id = event.update.update_id
+    now = time.monotonic()
+    _recent_errors.append(now)
+    if len(_recent_errors) == ERROR_BURST_LIMIT and now - _recent_errors[0] < 1:
+        logger.warning("Ошибка в обработчике update_id=%s: %r (шквал ошибок, без traceback)",
+                       update_id, event.exception)
+    else:
+        logger.error("Ошибка в обработчике update_id=%s: %r", update_id, event.exception,
+                     exc_info=event.exception)
     return True
 
-# ==== Старт с авто-ретраем при конфликте webhook ====
+# ==== Старт polling с авто-рестартом ====
+def install_stop_signals(stop: asyncio.Event):
+    # свои обработчики SIGINT/SIGTERM: сигнал aiogram теряется, если прийти между запусками polling
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):  # на Windows add_signal_handler нет
+            loop.add_signal_handler(sig, stop.set)
+
+async def sleep_or_stop(delay: float, stop: asyncio.Event) -> bool:
+    """Спит `delay` секунд; возвращает True, если за это время пришёл сигнал остановки."""
+    with suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(stop.wait(), delay)
+    return stop.is_set()
+
+async def poll_until_stopped(stop: asyncio.Event) -> bool:
+    """Крутит polling до сигнала (True) или до ошибки start_polling (исключение)."""
+    polling = asyncio.create_task(dp.start_polling(
+        bot,
+        allowed_updates=ALLOWED_UPDATES,
+        polling_timeout=POLLING_TIMEOUT,
+        handle_as_tasks=True,
+        backoff_config=POLLING_BACKOFF,
+        handle_signals=False,
+        close_bot_session=False,
+    ))
+    stopper = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait({polling, stopper}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopper.cancel()
+    if not polling.done():
+        await dp.stop_polling()  # штатно: aiogram гасит getUpdates и делает shutdown
+    await polling  # пробрасывает исключение start_polling, если оно было
+    return stop.is_set()
+
 async def main():
-    logger.info("Бот запускается…")
+    logger.info("Бот запускается в режиме polling…")
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+
     # первичная зачистка
     try:
         await bot.delete_webhook(drop_pending_updates=True)
         logger.info("Webhook удалён, drop_pending_updates=True")
     except Exception as e:
-        logger.warning(f"Не удалось удалить webhook: {e!r}")
+        logger.warning("Не удалось удалить webhook: %r", e)
 
-    # бесконечный цикл: если кто-то снова поставит webhook — снесём и продолжим
-    backoff = 1
-    while True:
-        try:
-            await dp.start_polling(bot, allowed_updates=["message"])
-        except TelegramConflictError:
-            logger.warning("Конфликт: активен webhook. Удаляю и перезапускаю polling…")
+    # цикл рестартов: start_polling падает только на старте (например, getMe
+    # при недоступном API); ошибки getUpdates, включая 409 Conflict, aiogram
+    # ретраит сам по POLLING_BACKOFF
+    try:
+        while not stop.is_set():
             try:
-                await bot.delete_webhook(drop_pending_updates=True)
+                if await poll_until_stopped(stop):
+                    break  # SIGINT/SIGTERM — не перезапускаем polling
             except Exception as e:
-                logger.warning(f"Не удалось удалить webhook: {e!r}")
-            await asyncio.sleep(backoff)
-            backoff = min(backoff * 2, 30)  # экспоненциальный бэкофф до 30с
-            continue
-        except Exception as e:
-            logger.exception(f"Неожиданная ошибка polling: {e!r}. Рестарт через 3с…")
-            await asyncio.sleep(3)
-            continue
+                logger.exception("Неожиданная ошибка polling: %r. Рестарт через 3с…", e)
+                if await sleep_or_stop(3, stop):
+                    break
+    finally:
+        # апдейты дожидаемся и хранилище закрываем в dp.shutdown (внутри start_polling)
+        await bot.session.close()
+        logger.info("Бот остановлен")
+
+# ==== Webhook-режим ====
+async def on_webhook_startup(bot: Bot):
+    await bot.set_webhook(
+        url=WEBHOOK_URL + WEBHOOK_PATH,
+        allowed_updates=ALLOWED_UPDATES,
+        secret_token=WEBHOOK_SECRET,
+        drop_pending_updates=True,
+    )
+    logger.info("Webhook установлен: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+def run_webhook():
+    # aiohttp.web и серверная часть aiogram нужны только здесь — не грузим их в polling-режиме
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    logger.info("Бот запускается в webhook-режиме…")
+    dp.startup.register(on_webhook_startup)
+    app = web.Application()
+
+    async def drain_before_close(_app):
+        await drain_updates()
+
+    app.on_shutdown.append(drain_before_close)  # раньше, чем SimpleRequestHandler закроет сессию
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEB_HOST, port=WEB_PORT)
+
+def use_uvloop():
+    # uvloop быстрее стандартного цикла на сетевой нагрузке; на Windows его нет
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop не установлен — используем стандартный event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    use_uvloop()
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        asyncio.run(main())